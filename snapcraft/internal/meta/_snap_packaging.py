@@ -33,6 +33,7 @@ from snapcraft.internal.project_loader import _config
 from snapcraft.extractors import _metadata
 from snapcraft.internal.deprecations import handle_deprecation_notice
 from snapcraft.internal.meta import errors as meta_errors, _manifest, _version
+from snapcraft.internal.meta.command import _clear_command_caches
 from snapcraft.internal.meta.application import ApplicationAdapter
 from snapcraft.internal.meta.snap import Snap
 
@@ -357,14 +358,21 @@ class _SnapPackaging:
                     os.remove(os.path.join(self.meta_gui_dir, f))
 
     def finalize_snap_meta_commands(self) -> None:
-        for app_name, app in self._snap_meta.apps.items():
-            # Prime commands only if adapter != "none",
-            # otherwise leave as-is.
-            if app.adapter != ApplicationAdapter.NONE:
-                app.prime_commands(
-                    base=self._project_config.project.info.base,
-                    prime_dir=self._prime_dir,
-                )
+        # Lookups are cached while priming, start from a clean slate as the
+        # prime directory may have changed since the last run and release
+        # the cached entries once done.
+        _clear_command_caches()
+        try:
+            for app_name, app in self._snap_meta.apps.items():
+                # Prime commands only if adapter != "none",
+                # otherwise leave as-is.
+                if app.adapter != ApplicationAdapter.NONE:
+                    app.prime_commands(
+                        base=self._project_config.project.info.base,
+                        prime_dir=self._prime_dir,
+                    )
+        finally:
+            _clear_command_caches()
 
     def finalize_snap_meta_command_chains(self) -> None:
         snapcraft_runner = self._generate_snapcraft_runner()
@@ -16,11 +16,21 @@
 
 import os
 import stat
+from typing import Optional
 
 
-def _executable_is_valid(path: str) -> bool:
-    if not os.path.isfile(path):
+def _stat_is_executable(stat_result: Optional[os.stat_result]) -> bool:
+    if stat_result is None or not stat.S_ISREG(stat_result.st_mode):
         return False
 
-    mode = os.stat(path).st_mode
+    mode = stat_result.st_mode
     return bool(mode & stat.S_IXUSR or mode & stat.S_IXGRP or mode & stat.S_IXOTH)
+
+
+def _executable_is_valid(path: str) -> bool:
+    try:
+        stat_result = os.stat(path)
+    except OSError:
+        return False
+
+    return _stat_is_executable(stat_result)
@@ -15,20 +15,39 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import contextlib
+import functools
+import glob
+import itertools
 import logging
 import os
-import re
 import shlex
 import shutil
-from typing import List, Optional
+from typing import Dict, Iterator, List, Optional, Tuple
 
 from . import errors
-from ._utils import _executable_is_valid
+from ._utils import _executable_is_valid, _stat_is_executable
 from snapcraft.internal import common
 
 
 logger = logging.getLogger(__name__)
-_COMMAND_PATTERN = re.compile("^[A-Za-z0-9. _#:$-][A-Za-z0-9/. _#:$-]*$")
+# The character set of snapd's command pattern,
+# "^[A-Za-z0-9. _#:$-][A-Za-z0-9/. _#:$-]*$", checked with str.translate which
+# is considerably cheaper than running the regular expression engine.
+_COMMAND_ALLOWED_FIRST = frozenset(
+    "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789. _#:$-"
+)
+_COMMAND_ALLOWED_REST = _COMMAND_ALLOWED_FIRST | frozenset("/")
+_COMMAND_DELETE_TABLE = str.maketrans("", "", "".join(_COMMAND_ALLOWED_REST))
+# BINPRM_BUF_SIZE, the amount of bytes the kernel reads to find the shebang.
+_SHEBANG_MAX_LENGTH = 256
+# Conventional locations for binaries outside of the standard bin paths,
+# probed before resorting to walking the whole prime directory.
+_CONVENTIONAL_BIN_PATTERNS = (
+    os.path.join("opt", "*", "bin"),
+    os.path.join("usr", "lib", "*", "bin"),
+    os.path.join("snap", "*", "current", "bin"),
+)
+_StatCache = Dict[str, Optional[os.stat_result]]
 _FMT_COMMAND_SNAP_STRIP = "Stripped '$SNAP/' from command {!r}."
 _FMT_COMMAND_ROOT = (
     "The command {!r} was not found in the prime directory, it has been "
@@ -43,16 +62,36 @@ _FMT_SNAPD_WRAPPER = (
 )
 
 
+@functools.lru_cache(maxsize=512)
+def _read_shebang_line(file_path: str) -> Optional[str]:
+    """Returns the shebang line from file_path or None if there is none."""
+    # A single read is enough as the kernel does not look past the first
+    # _SHEBANG_MAX_LENGTH bytes when interpreting the shebang either.
+    try:
+        fd = os.open(file_path, os.O_RDONLY | getattr(os, "O_CLOEXEC", 0))
+    except FileNotFoundError:
+        # Callers already know the path exists from their cached stat, this
+        # only keeps a missing file from being an error.
+        return None
+    try:
+        buf = os.read(fd, _SHEBANG_MAX_LENGTH)
+    finally:
+        os.close(fd)
+
+    if not buf.startswith(b"#!"):
+        return None
+    newline_index = buf.find(b"\n", 2)
+    if newline_index < 0:
+        newline_index = len(buf)
+    return buf[2:newline_index].strip().decode("utf-8")
+
+
 def _get_shebang_from_file(file_path: str) -> List[str]:
     """Returns the shebang from file_path."""
-    if not os.path.exists(file_path):
+    shebang_line = _read_shebang_line(file_path)
+    if shebang_line is None:
         raise errors.ShebangNotFoundError()
 
-    with open(file_path, "rb") as exefile:
-        if exefile.read(2) != b"#!":
-            raise errors.ShebangNotFoundError()
-        shebang_line = exefile.readline().strip().decode("utf-8")
-
     # posix is set to False to respect the quoting of variables.
     shebang_parts = shlex.split(shebang_line, posix=False)
     # remove the leading /usr/bin/env.
@@ -65,26 +104,96 @@ def _get_shebang_from_file(file_path: str) -> List[str]:
     return shebang_parts
 
 
+def _entry_is_executable(entry: os.DirEntry) -> bool:
+    # readdir already told us this is a regular file, only the executable
+    # bit is left to check.
+    if entry.is_file(follow_symlinks=False):
+        return os.access(entry.path, os.X_OK)
+    # Symbolic links need their target validated.
+    return _executable_is_valid(entry.path)
+
+
+def _walk_scandir(path: str) -> Iterator[Tuple[str, List[os.DirEntry]]]:
+    """Yield each directory under path along with its non-directory entries."""
+    # Top-down in the same order as os.walk, relying on the file type from
+    # readdir to avoid a stat per entry. Symbolic links to directories are
+    # not followed.
+    entries: List[os.DirEntry] = []
+    subdirs: List[str] = []
+    try:
+        with os.scandir(path) as scandir_it:
+            for entry in scandir_it:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                else:
+                    entries.append(entry)
+    except OSError:
+        # Unreadable directories are skipped, just like os.walk does.
+        return
+
+    yield path, entries
+    for subdir in subdirs:
+        yield from _walk_scandir(subdir)
+
+
+@functools.lru_cache(maxsize=8)
+def _prime_dir_index(
+    prime_dir: str
+) -> Tuple[Dict[str, List[os.DirEntry]], Dict[str, int]]:
+    """Return the entries in prime_dir indexed by name and directory positions."""
+    # A single walk serves every command not in the standard bin paths, entries
+    # are kept in walk order.
+    entries_by_name: Dict[str, List[os.DirEntry]] = dict()
+    dir_positions: Dict[str, int] = dict()
+    for position, (dir_path, entries) in enumerate(_walk_scandir(prime_dir)):
+        dir_positions[dir_path] = position
+        for entry in entries:
+            entries_by_name.setdefault(entry.name, []).append(entry)
+    return entries_by_name, dir_positions
+
+
+@functools.lru_cache(maxsize=32)
+def _bin_paths(prime_dir: str) -> Tuple[str, ...]:
+    return tuple(common.get_bin_paths(root=prime_dir))
+
+
+def _indexed_executables(*, binary: str, prime_dir: str) -> Iterator[str]:
+    entries_by_name, dir_positions = _prime_dir_index(prime_dir)
+    binary = os.path.normpath(binary)
+    candidates = entries_by_name.get(os.path.basename(binary), [])
+    # A binary with a subpath, such as bin/roslaunch, is looked up relative to
+    # every directory in the walk (e.g. opt/ros/melodic/bin/roslaunch), in the
+    # order those directories are walked.
+    if os.sep in binary:
+        suffix = os.sep + binary
+        candidates = sorted(
+            (e for e in candidates if e.path.endswith(suffix)),
+            key=lambda e: dir_positions.get(e.path[: -len(suffix)], 0),
+        )
+
+    for entry in candidates:
+        if _entry_is_executable(entry):
+            yield entry.path
+
+
+@functools.lru_cache(maxsize=512)
 def _find_executable(*, binary: str, prime_dir: str) -> str:
-    found_path: Optional[str] = None
-    binary_paths = (
-        os.path.join(p, binary) for p in common.get_bin_paths(root=prime_dir)
+    binary_paths = (os.path.join(p, binary) for p in _bin_paths(prime_dir))
+    # Last chance to find in the prime_dir, mostly for backwards compatibility,
+    # to find the executable, historical snaps like those built with the catkin
+    # plugin will have roslaunch in a path like /opt/ros/bin/roslaunch.
+    # Conventional locations are tried first to avoid walking the tree.
+    conventional_paths = itertools.chain.from_iterable(
+        sorted(glob.glob(os.path.join(glob.escape(prime_dir), p, glob.escape(binary))))
+        for p in _CONVENTIONAL_BIN_PATTERNS
     )
-    for binary_path in binary_paths:
-        if _executable_is_valid(binary_path):
-            found_path = binary_path
-            break
-    else:
-        # Last chance to find in the prime_dir, mostly for backwards compatibility,
-        # to find the executable, historical snaps like those built with the catkin
-        # plugin will have roslaunch in a path like /opt/ros/bin/roslaunch.
-        for root, _, files in os.walk(prime_dir):
-            if _executable_is_valid(os.path.join(root, binary)):
-                found_path = os.path.join(root, binary)
-                break
-        else:
-            # Finally, check if it is part of the system.
-            found_path = shutil.which(binary)
+    # All of these are lazily evaluated, stopping at the first valid executable.
+    candidate_paths = itertools.chain(
+        filter(_executable_is_valid, itertools.chain(binary_paths, conventional_paths)),
+        _indexed_executables(binary=binary, prime_dir=prime_dir),
+    )
+    # Finally, check if it is part of the system.
+    found_path = next(candidate_paths, None) or shutil.which(binary)
 
     if found_path is None:
         raise errors.PrimedCommandNotFoundError(binary)
@@ -92,16 +201,104 @@ def _find_executable(*, binary: str, prime_dir: str) -> str:
     return found_path
 
 
+def _clear_command_caches() -> None:
+    """Forget cached lookups, the prime directory may have changed."""
+    _read_shebang_line.cache_clear()
+    _bin_paths.cache_clear()
+    _prime_dir_index.cache_clear()
+    _find_executable.cache_clear()
+
+
+def _matches_command_pattern(command: str) -> bool:
+    # Like the "$" anchor of the pattern, allow for a single trailing newline.
+    if command.endswith("\n"):
+        command = command[:-1]
+    if not command or command[0] not in _COMMAND_ALLOWED_FIRST:
+        return False
+    # Anything left after deleting the allowed characters is disallowed.
+    return not command.translate(_COMMAND_DELETE_TABLE)
+
+
+def _cached_stat(path: str, *, stat_cache: _StatCache) -> Optional[os.stat_result]:
+    """Return the stat result for path, None if it does not exist."""
+    try:
+        return stat_cache[path]
+    except KeyError:
+        pass
+
+    stat_result: Optional[os.stat_result]
+    try:
+        stat_result = os.stat(path)
+    except OSError:
+        stat_result = None
+    stat_cache[path] = stat_result
+    return stat_result
+
+
+def _remove_prefix(value: str, prefix: str) -> str:
+    """Backport of str.removeprefix, new in Python 3.9."""
+    if value.startswith(prefix):
+        return value[len(prefix) :]
+    return value
+
+
 def _get_command_path(*, command: str, prime_dir: str) -> str:
     # Strip leading "/"
-    command = re.sub(r"^/", "", command)
+    command = _remove_prefix(command, "/")
     # Strip leading "$SNAP/"
-    command = re.sub(r"^\$SNAP/", "", command)
+    command = _remove_prefix(command, "$SNAP/")
 
     return os.path.join(prime_dir, command)
 
 
-def _massage_command(*, command: str, prime_dir: str) -> str:
+def _has_quoting(command: str) -> bool:
+    return '"' in command or "'" in command or "\\" in command
+
+
+def _split_command(command: str, *, posix: bool = True) -> List[str]:
+    """Return the lexical split of command."""
+    # Avoid the pure Python shlex tokenizer when a plain split is equivalent, in
+    # printable commands the space is the only whitespace str.split splits on.
+    if command.isprintable() and not _has_quoting(command):
+        return command.split()
+    return shlex.split(command, posix=posix)
+
+
+def _get_unmassaged_parts(
+    *, command: str, prime_dir: str, stat_cache: _StatCache
+) -> Optional[List[str]]:
+    """Return the lexical split of command if there is nothing to massage.
+
+    That is the common case of a command that already conforms with the
+    command pattern and points to an existing file in the prime directory,
+    by a normalized path, that has no shebang.
+    """
+    if not _matches_command_pattern(command) or command.startswith("$SNAP/"):
+        return None
+
+    command_parts = _split_command(command, posix=False)
+    command_path = os.path.join(prime_dir, command_parts[0])
+    if (
+        os.path.normpath(command_parts[0]) == command_parts[0]
+        and _cached_stat(command_path, stat_cache=stat_cache) is not None
+        and _read_shebang_line(command_path) is None
+    ):
+        return command_parts
+    return None
+
+
+def _massage_command(
+    *, command: str, prime_dir: str, stat_cache: Optional[_StatCache] = None
+) -> str:
+    """Returns the massaged command, see _massage_command_parts."""
+    return _massage_command_parts(
+        command=command, prime_dir=prime_dir, stat_cache=stat_cache
+    )[0]
+
+
+def _massage_command_parts(
+    *, command: str, prime_dir: str, stat_cache: Optional[_StatCache] = None
+) -> Tuple[str, Optional[List[str]]]:
     """Rewrite command to take into account interpreter and pathing.
 
     (1) Interpreter: if shebang is found in file, explicitly prepend
@@ -112,15 +309,28 @@ def _massage_command(*, command: str, prime_dir: str) -> str:
         is ambiguous.  If found in prime_dir, set the path relative
         to snap.
 
-    Returns massaged command."""
+    Paths looked up are recorded in stat_cache, if provided, so callers can
+    reuse the results.
+
+    Returns massaged command and its lexical split, None for commands starting
+    with "/" as those are not split."""
+
+    if stat_cache is None:
+        stat_cache = dict()
 
     # If command starts with "/" we have no option but to use a wrapper.
     if command.startswith("/"):
-        return command
+        return command, None
+
+    unmassaged_parts = _get_unmassaged_parts(
+        command=command, prime_dir=prime_dir, stat_cache=stat_cache
+    )
+    if unmassaged_parts is not None:
+        return " ".join(unmassaged_parts), unmassaged_parts
 
     # command_parts holds the lexical split of a command entry.
     # posix is set to False to respect the quoting of variables.
-    command_parts = shlex.split(command, posix=False)
+    command_parts = _split_command(command, posix=False)
     # Make a note now that $SNAP if found this path will not make it into the
     # resulting command entry.
     if command_parts[0].startswith("$SNAP/"):
@@ -135,24 +345,31 @@ def _massage_command(*, command: str, prime_dir: str) -> str:
     # for backwards compatibility (this might be part of a content interfaced
     # snap).
     # If a shebang is found, command_path is rewritten to point to the shebang.
-    with contextlib.suppress(errors.ShebangNotFoundError, errors.ShebangInRoot):
-        shebang_parts = _get_shebang_from_file(command_path)
-        # Add the shebang (interpreter) to the front of the command.
-        command_parts = shebang_parts + command_parts
-        # And make sure the original command is prepended with $SNAP so it is
-        # found and not already set.
-        if not command_parts[1].startswith("$SNAP"):
-            command_parts[1] = os.path.join("$SNAP", command_parts[1])
-        command_path = _get_command_path(command=shebang_parts[0], prime_dir=prime_dir)
+    command_exists = _cached_stat(command_path, stat_cache=stat_cache) is not None
+    if command_exists:
+        with contextlib.suppress(errors.ShebangNotFoundError, errors.ShebangInRoot):
+            shebang_parts = _get_shebang_from_file(command_path)
+            # Add the shebang (interpreter) to the front of the command.
+            command_parts = shebang_parts + command_parts
+            # And make sure the original command is prepended with $SNAP so it is
+            # found and not already set.
+            if not command_parts[1].startswith("$SNAP"):
+                command_parts[1] = os.path.join("$SNAP", command_parts[1])
+            command_path = _get_command_path(
+                command=shebang_parts[0], prime_dir=prime_dir
+            )
+            command_exists = (
+                _cached_stat(command_path, stat_cache=stat_cache) is not None
+            )
 
     # If the command is part of the snap (starts with $SNAP) it NEEDS to exist
     # within the prime directory.
-    if not os.path.exists(command_path) and command_parts[0].startswith("$SNAP/"):
+    if not command_exists and command_parts[0].startswith("$SNAP/"):
         raise errors.PrimedCommandNotFoundError(command_parts[0])
     # if the command is "pathless", make an attempt to find the executable within
     # the prime directory and as a last resort (for backwards compatibility),
     # at the root of the filesystem.
-    elif not os.path.exists(command_path):
+    elif not command_exists:
         command_path = _find_executable(binary=command_parts[0], prime_dir=prime_dir)
 
     # A command found within the prime directory will have a command_path that
@@ -166,12 +383,21 @@ def _massage_command(*, command: str, prime_dir: str) -> str:
         logger.warning(_FMT_COMMAND_ROOT.format(command, command_path))
         command_parts[0] = command_path
 
-    return " ".join(command_parts)
+    return " ".join(command_parts), command_parts
 
 
 class Command:
     """Representation of a command string."""
 
+    __slots__ = (
+        "_app_name",
+        "_command_name",
+        "command",
+        "wrapped_command",
+        "massaged_command",
+        "_primed_for",
+    )
+
     def __str__(self) -> str:
         return self.command
 
@@ -181,6 +407,8 @@ class Command:
         self.command = command
         self.wrapped_command: Optional[str] = None
         self.massaged_command: Optional[str] = None
+        # The primed command and the arguments it was primed with.
+        self._primed_for: Optional[Tuple[str, str, bool, bool]] = None
 
     @property
     def command_name(self) -> str:
@@ -194,7 +422,7 @@ class Command:
         else:
             command = self.command
 
-        return command.startswith("/") or not _COMMAND_PATTERN.match(command)
+        return command.startswith("/") or not _matches_command_pattern(command)
 
     @property
     def wrapped_command_name(self) -> str:
@@ -208,28 +436,50 @@ class Command:
     ) -> str:
         """Finalize and prime command, massaging as necessary.
 
-        Check if command is in prime_dir and raise exception if not valid."""
+        Check if command is in prime_dir and raise exception if not valid.
+        Priming an already primed command with the same arguments is a no-op,
+        call invalidate to force priming again."""
 
+        primed_for = (self.command, prime_dir, can_use_wrapper, massage_command)
+        if self._primed_for == primed_for:
+            return self.command
+
+        # Shared with _massage_command_parts so the final validation does not
+        # stat paths that were already looked up.
+        stat_cache: _StatCache = dict()
+        command_parts: Optional[List[str]] = None
         if massage_command:
-            self.command = _massage_command(command=self.command, prime_dir=prime_dir)
+            self.command, command_parts = _massage_command_parts(
+                command=self.command, prime_dir=prime_dir, stat_cache=stat_cache
+            )
+            self.massaged_command = self.command
 
         if self.requires_wrapper:
             if not can_use_wrapper:
                 raise errors.InvalidAppCommandFormatError(self.command, self._app_name)
             self.wrapped_command = self.command
-            if not _COMMAND_PATTERN.match(self.command):
+            if not _matches_command_pattern(self.command):
                 logger.warning(_FMT_SNAPD_WRAPPER.format(self.command))
             self.command = self.wrapped_command_name
         else:
-            command_parts = shlex.split(self.command)
+            # Reuse the split from massaging, unless the first part is quoted
+            # as it is split without posix semantics.
+            if command_parts is None or _has_quoting(command_parts[0]):
+                command_parts = _split_command(self.command)
             command_path = os.path.join(prime_dir, command_parts[0])
-            if not _executable_is_valid(command_path):
+            stat_result = _cached_stat(command_path, stat_cache=stat_cache)
+            if not _stat_is_executable(stat_result):
                 raise errors.InvalidAppCommandNotExecutable(
                     command=self.command, app_name=self._app_name
                 )
 
+        self._primed_for = (self.command, prime_dir, can_use_wrapper, massage_command)
         return self.command
 
+    def invalidate(self) -> None:
+        """Forget about previous priming, the prime directory has changed."""
+        self._primed_for = None
+
     def write_wrapper(self, *, prime_dir: str) -> Optional[str]:
         """Write command wrapper if required for this command."""
         if self.wrapped_command is None:
@@ -16,9 +16,10 @@
 
 import logging
 import os
+from unittest import mock
 
 import fixtures
-from testtools.matchers import Equals, Is, FileContains, FileExists
+from testtools.matchers import Equals, Is, FileContains, FileExists, HasLength
 
 from snapcraft.internal.meta import command, errors
 from tests import unit
@@ -63,6 +64,73 @@ class CommandWithoutWrapperAllowedTest(unit.TestCase):
 
         self.assertThat(cmd.command, Equals("foo bar -baz"))
 
+    def test_command_with_trailing_newline(self):
+        _create_file(os.path.join(self.path, "foo"))
+        cmd = command.Command(app_name="foo", command_name="command", command="foo\n")
+
+        cmd.prime_command(
+            can_use_wrapper=False, massage_command=False, prime_dir=self.path
+        )
+
+        self.assertThat(cmd.command, Equals("foo\n"))
+
+    def test_command_primed_twice(self):
+        command_path = os.path.join(self.path, "foo")
+        _create_file(command_path)
+        cmd = command.Command(app_name="foo", command_name="command", command="foo")
+        cmd.prime_command(
+            can_use_wrapper=False, massage_command=True, prime_dir=self.path
+        )
+
+        # Already primed, so the command is not validated again.
+        os.chmod(command_path, 0o644)
+        cmd.prime_command(
+            can_use_wrapper=False, massage_command=True, prime_dir=self.path
+        )
+
+        self.assertThat(cmd.command, Equals("foo"))
+
+        cmd.invalidate()
+        self.assertRaises(
+            errors.InvalidAppCommandNotExecutable,
+            cmd.prime_command,
+            can_use_wrapper=False,
+            massage_command=True,
+            prime_dir=self.path,
+        )
+
+    def test_command_stat_once(self):
+        command_path = os.path.join(self.path, "bin", "foo")
+        _create_file(command_path)
+        cmd = command.Command(app_name="foo", command_name="command", command="bin/foo")
+
+        with mock.patch("os.stat", wraps=os.stat) as stat_mock:
+            cmd.prime_command(
+                can_use_wrapper=False, massage_command=True, prime_dir=self.path
+            )
+
+        self.assertThat(cmd.command, Equals("bin/foo"))
+        # Massaging and priming share the stat of the command path.
+        self.assertThat(
+            [c for c in stat_mock.call_args_list if c == mock.call(command_path)],
+            HasLength(1),
+        )
+
+    def test_cached_stat_missing_path(self):
+        missing_path = os.path.join(self.path, "missing")
+        stat_cache = dict()
+
+        with mock.patch("os.stat", wraps=os.stat) as stat_mock:
+            self.assertThat(
+                command._cached_stat(missing_path, stat_cache=stat_cache), Is(None)
+            )
+            self.assertThat(
+                command._cached_stat(missing_path, stat_cache=stat_cache), Is(None)
+            )
+
+        self.assertThat(stat_cache, Equals({missing_path: None}))
+        stat_mock.assert_called_once_with(missing_path)
+
 
 class CommandWithoutWrapperAllowedTestErrors(unit.TestCase):
     def setUp(self):
@@ -234,6 +302,28 @@ class CommandWithWrapperTest(unit.TestCase):
             ),
         )
 
+    def test_command_starts_with_slash_and_unbalanced_quote(self):
+        cmd = command.Command(
+            app_name="foo", command_name="command", command="/foo 'unterminated"
+        )
+
+        cmd.prime_command(
+            can_use_wrapper=True, massage_command=True, prime_dir=self.path
+        )
+
+        self.expectThat(cmd.command, Equals("command-foo.wrapper"))
+        self.assertThat(
+            self.fake_logger.output.strip(),
+            Equals(
+                "A shell wrapper will be generated for command "
+                "\"/foo 'unterminated\" "
+                "as it does not conform with the command pattern expected "
+                "by the runtime. Commands must be relative to the prime "
+                "directory and can only consist of alphanumeric characters, "
+                "spaces, and the following special characters: / . _ # : $ -"
+            ),
+        )
+
     def test_command_relative_command_found_in_slash(self):
         cmd = command.Command(app_name="foo", command_name="command", command="sh")
 
@@ -21,6 +21,12 @@ import pytest
 from snapcraft.internal.meta import command, errors
 
 
+def _create_executable(path, *, mode=0o755):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.touch()
+    path.chmod(mode)
+
+
 class TestCommandMangle:
     scenarios = (
         (
@@ -147,6 +153,50 @@ class TestCommandMangle:
                 interpreter_path=None,
             ),
         ),
+        (
+            "find in nested non standard path",
+            dict(
+                command_path="opt/ros/bin/roslaunch",
+                command_value="roslaunch bar",
+                expected_command="opt/ros/bin/roslaunch bar",
+                expected_log=None,
+                shebang="",
+                interpreter_path=None,
+            ),
+        ),
+        (
+            "find in deep non standard path",
+            dict(
+                command_path="a/b/c/foo",
+                command_value="foo bar",
+                expected_command="a/b/c/foo bar",
+                expected_log=None,
+                shebang="",
+                interpreter_path=None,
+            ),
+        ),
+        (
+            "find subpath in non standard path",
+            dict(
+                command_path="a/b/bin/foo",
+                command_value="bin/foo bar",
+                expected_command="a/b/bin/foo bar",
+                expected_log=None,
+                shebang="",
+                interpreter_path=None,
+            ),
+        ),
+        (
+            "find subpath in nested conventional path",
+            dict(
+                command_path="opt/ros/melodic/bin/roslaunch",
+                command_value="bin/roslaunch bar",
+                expected_command="opt/ros/melodic/bin/roslaunch bar",
+                expected_log=None,
+                shebang="",
+                interpreter_path=None,
+            ),
+        ),
         (
             "find in non stardard path and preferred over root",
             dict(
@@ -279,3 +329,145 @@ def test_binary_not_executable(tmp_work_path):
         command._massage_command(
             command="not-executable", prime_dir=tmp_work_path.as_posix()
         )
+
+
+def test_find_binary_conventional_path_preferred_over_walk(tmp_work_path):
+    # opt/foo is found first when walking the prime directory.
+    _create_executable(tmp_work_path / "opt" / "foo")
+    _create_executable(tmp_work_path / "opt" / "ros" / "bin" / "foo")
+
+    assert (
+        command._massage_command(command="foo", prime_dir=tmp_work_path.as_posix())
+        == "opt/ros/bin/foo"
+    )
+
+
+def test_find_binary_walk_skips_non_executable(tmp_work_path):
+    # a/foo is found first when walking the prime directory.
+    _create_executable(tmp_work_path / "a" / "foo", mode=0o644)
+    _create_executable(tmp_work_path / "a" / "b" / "foo")
+
+    assert (
+        command._massage_command(command="foo", prime_dir=tmp_work_path.as_posix())
+        == "a/b/foo"
+    )
+
+
+def test_find_subpath_binary_walk_order(tmp_work_path):
+    # a is walked before a/c, so a/bin/foo must win regardless of the order
+    # in which the entries of a are listed.
+    _create_executable(tmp_work_path / "a" / "bin" / "foo")
+    _create_executable(tmp_work_path / "a" / "c" / "bin" / "foo")
+
+    assert (
+        command._massage_command(command="bin/foo", prime_dir=tmp_work_path.as_posix())
+        == "a/bin/foo"
+    )
+
+
+def test_find_binary_after_clearing_caches(tmp_work_path):
+    old_path = tmp_work_path / "bar" / "foo"
+    _create_executable(old_path)
+
+    assert (
+        command._massage_command(command="foo", prime_dir=tmp_work_path.as_posix())
+        == "bar/foo"
+    )
+
+    old_path.unlink()
+    _create_executable(tmp_work_path / "bin" / "foo")
+    command._clear_command_caches()
+
+    assert (
+        command._massage_command(command="foo", prime_dir=tmp_work_path.as_posix())
+        == "bin/foo"
+    )
+
+
+def test_non_breaking_space_is_not_a_separator(tmp_work_path):
+    _create_executable(tmp_work_path / "bin" / "foo")
+
+    # Like shlex, only split on spaces, tabs and newlines.
+    assert command._split_command("bin/foo\xa0arg") == ["bin/foo\xa0arg"]
+    with pytest.raises(errors.PrimedCommandNotFoundError):
+        command._massage_command(
+            command="bin/foo\xa0arg", prime_dir=tmp_work_path.as_posix()
+        )
+
+
+def test_unmassaged_command_returned_unchanged(tmp_work_path):
+    _create_executable(tmp_work_path / "bin" / "foo")
+
+    assert (
+        command._get_unmassaged_parts(
+            command="bin/foo arg", prime_dir=tmp_work_path.as_posix(), stat_cache=dict()
+        )
+        == ["bin/foo", "arg"]
+    )
+    assert (
+        command._massage_command(
+            command="bin/foo arg", prime_dir=tmp_work_path.as_posix()
+        )
+        == "bin/foo arg"
+    )
+
+
+@pytest.mark.parametrize("command_value", ["./bin/foo arg", "bin//foo arg"])
+def test_unnormalized_command_is_massaged(tmp_work_path, command_value):
+    _create_executable(tmp_work_path / "bin" / "foo")
+
+    assert (
+        command._get_unmassaged_parts(
+            command=command_value,
+            prime_dir=tmp_work_path.as_posix(),
+            stat_cache=dict(),
+        )
+        is None
+    )
+    assert (
+        command._massage_command(
+            command=command_value, prime_dir=tmp_work_path.as_posix()
+        )
+        == "bin/foo arg"
+    )
+
+
+def test_prime_dir_walked_once(monkeypatch, tmp_work_path):
+    prime_dir = tmp_work_path.as_posix()
+    _create_executable(tmp_work_path / "a" / "foo")
+    _create_executable(tmp_work_path / "b" / "bar")
+
+    walked = []
+    walk_scandir = command._walk_scandir
+
+    def _counting_walk_scandir(path):
+        # Subdirectories are walked recursively through this same name.
+        if path == prime_dir:
+            walked.append(path)
+        return walk_scandir(path)
+
+    monkeypatch.setattr(command, "_walk_scandir", _counting_walk_scandir)
+    command._clear_command_caches()
+
+    assert command._massage_command(command="foo", prime_dir=prime_dir) == "a/foo"
+    assert command._massage_command(command="bar", prime_dir=prime_dir) == "b/bar"
+    assert walked == [prime_dir]
+
+
+def test_clear_command_caches_drops_prime_dir_index(tmp_work_path):
+    prime_dir = tmp_work_path.as_posix()
+    _create_executable(tmp_work_path / "a" / "foo")
+
+    assert command._massage_command(command="foo", prime_dir=prime_dir) == "a/foo"
+
+    # The index of the prime directory is stale until the caches are cleared.
+    _create_executable(tmp_work_path / "b" / "not-in-path")
+    with pytest.raises(errors.PrimedCommandNotFoundError):
+        command._massage_command(command="not-in-path", prime_dir=prime_dir)
+
+    command._clear_command_caches()
+
+    assert (
+        command._massage_command(command="not-in-path", prime_dir=prime_dir)
+        == "b/not-in-path"
+    )
@@ -32,36 +32,38 @@ from tests import unit
 from tests.unit.commands import CommandBaseTestCase
 
 
+_SNAPCRAFT_YAML = textwrap.dedent(
+    """\
+    name: my-snap-name
+    base: core18
+    summary: summary
+    description: description
+
+    adopt-info: my-part
+    confinement: devmode
+
+    parts:
+        my-part:
+            plugin: dump
+            source: src
+            override-pull: |
+                snapcraftctl pull
+                snapcraftctl set-grade devel
+                version="$(cat version.txt)"
+                snapcraftctl set-version "$version"
+    """
+)
+
+
 class ScriptletCommandsTestCase(CommandBaseTestCase):
     def setUp(self):
         super().setUp()
 
-        self.make_snapcraft_yaml(
-            textwrap.dedent(
-                """\
-                name: my-snap-name
-                base: core18
-                summary: summary
-                description: description
-
-                adopt-info: my-part
-                confinement: devmode
-
-                parts:
-                    my-part:
-                        plugin: dump
-                        source: src
-                        override-pull: |
-                            snapcraftctl pull
-                            snapcraftctl set-grade devel
-                            version="$(cat version.txt)"
-                            snapcraftctl set-version "$version"
-                """
-            )
-        )
+        self.make_snapcraft_yaml(_SNAPCRAFT_YAML)
 
         os.mkdir("src")
-        open(os.path.join("src", "version.txt"), "w").write("v1.0")
+        with open(os.path.join("src", "version.txt"), "w") as version_file:
+            version_file.write("v1.0")
 
         fake_install_build_packages = fixtures.MockPatch(
             "snapcraft.internal.lifecycle._runner._install_build_packages",
@@ -85,7 +87,8 @@ class ScriptletCommandsTestCase(CommandBaseTestCase):
         self.assertThat(y["version"], Equals("v1.0"))
 
         # modifying source file (src/version.txt) will trigger re-pull
-        open(os.path.join("src", "version.txt"), "w").write("v2.0")
+        with open(os.path.join("src", "version.txt"), "w") as version_file:
+            version_file.write("v2.0")
         self.run_command(["prime"])
 
         with open(os.path.join("prime", "meta", "snap.yaml")) as f: